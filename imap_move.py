@@ -5,50 +5,66 @@ Move message from one folder to another one in a targeted mailbox
 """
 import argparse
 import atexit
+import base64
+import binascii
 import signal
 import imaplib
 import logging
 import os
 import pathlib
+import queue
+import re
+import socket
 import sys
+import threading
 import xml.etree.ElementTree as etree
-from logging.handlers import RotatingFileHandler
+from collections.abc import Iterator
+from logging.handlers import MemoryHandler, RotatingFileHandler
 
 __author__ = 'David Rolland, contact@infodavid.org'
 __copyright__ = 'Copyright © 2023 David Rolland'
 __license__ = 'MIT'
 
 IMAP4_PORT: int = 143
+MAX_UIDS_PER_COMMAND: int = 1000  # Maximum number of UIDs covered by a single UID command
+PIPELINE_DEPTH: int = 16  # Number of commands sent without waiting for the responses of the previous ones
+APPEND_BATCH_SIZE: int = 64  # Maximum number of messages appended together when MULTIAPPEND or LITERAL+ is supported
+APPEND_BATCH_BYTES: int = 32 * 1024 * 1024  # Size above which a batch is appended without waiting for more messages
+FETCH_CHUNK_SIZE: int = 1024 * 1024  # Size of the slices used to fetch the messages
+PROGRESS_INTERVAL: int = 100  # Number of moved messages between two progress records when not verbose
+FETCH_QUEUE_SIZE: int = 8  # Number of fetched messages waiting to be appended before the fetching is paused
+SOCKET_BUFFER_SIZE: int = 1024 * 1024  # Size of the send and receive buffers of the sockets
+UID_PATTERN = re.compile(rb'UID (\d+)')
+SIZE_PATTERN = re.compile(rb'RFC822\.SIZE (\d+)')
+APPENDUID_PATTERN = re.compile(rb'\[APPENDUID \d+ ([\d:,]+)\]')
+# FLAGS and INTERNALDATE are captured in a single pass whatever their order in the FETCH response
+ENVELOPE_PATTERN = re.compile(rb'^(?=.*?FLAGS \((?P<flags>[^)]*)\))(?=.*?INTERNALDATE "(?P<date>[^"]+)")', re.DOTALL)
+NON_FATAL_RESPONSES = (b'TRYCREATE', b'NO MATCHING MESSAGES')  # Responses of UID MOVE or COPY which must not stop the process
+_OPEN_MAILBOXES: list = []  # IMAP sessions to close on exit, registered after login
+fetch_thread: threading.Thread = None  # Worker fetching the messages from the source, set once started
+fetched_messages: queue.Queue = None  # Messages fetched by the worker and waiting to be appended on the target
+deleted_messages: queue.Queue = None  # UIDs of the messages appended on the target and waiting to be flagged as deleted
+fetch_stop: threading.Event = None  # Event set to stop the worker
 
 
-class _ObjectView:
+class ImapSettings:
     """
-    Wrapper of the object
+    IMAP Settings.
     """
+    __slots__ = ('server', 'use_ssl', 'port', 'user', '_password_b64', '_password', 'folder', 'trash')
 
-    def __init__(self, d):
+    def __init__(self):
         """
         Initialize
-        :param d: the data
         """
-        self.__dict__ = d
-
-    def __str__(self) -> str:
-        """ Returns the string representation of the view """
-        return str(self.__dict__)
-
-
-class ImapSettings:
-    """
-    IMAP Settings.
-    """
-    server: str = None  # Full name or IP address of your IMAP server
-    use_ssl: bool = False  # Set True to use SSL for the IMAP server
-    port: int = IMAP4_PORT  # Port of your IMAP server
-    user: str = None  # User used to connect to your IMAP server
-    password: str = None  # Password (base64 encoded) of the user used to connect to your IMAP server
-    folder: str = None  # The folder from where to cut messages from or to paste messages into
-    trash: str = None  # The trash folder of your IMAP server
+        self.server: str = None  # Full name or IP address of your IMAP server
+        self.use_ssl: bool = False  # Set True to use SSL for the IMAP server
+        self.port: int = IMAP4_PORT  # Port of your IMAP server
+        self.user: str = None  # User used to connect to your IMAP server
+        self._password_b64: str = None  # Password (base64 encoded) of the user used to connect to your IMAP server
+        self._password: str = None  # Decoded password, set on first use
+        self.folder: str = None  # The folder from where to cut messages from or to paste messages into
+        self.trash: str = None  # The trash folder of your IMAP server
 
     def parse(self, node: etree.Element, accounts: {}) -> None:
         """
@@ -56,76 +72,104 @@ class ImapSettings:
         :param node: the node
         :param accounts: the accounts
         """
-        self.server = node.get('server')
-        v = node.get('port')
-        if v is not None:
-            self.port = int(v)
-        else:
-            self.port = 143
-        v = node.get('folder')
-        if v is not None:
-            self.folder = str(v)
-        else:
-            self.folder = '"[Gmail]/Sent Mail"'
-        v = node.get('trash')
-        if v is not None:
-            self.trash = str(v)
-        else:
-            self.trash = '"[Gmail]/Trash"'
-        self.use_ssl = node.get('ssl') == 'True' or node.get('ssl') == 'true'
-        account_id: str = node.get('account-id')
+        attributes: dict = node.attrib
+        self.server = attributes.get('server')
+        self.port = int(attributes['port']) if 'port' in attributes else IMAP4_PORT
+        self.folder = attributes.get('folder', '"[Gmail]/Sent Mail"')
+        self.trash = attributes.get('trash', '"[Gmail]/Trash"')
+        self.use_ssl = attributes.get('ssl', '').lower() == 'true'
+        account_id: str = attributes.get('account-id')
         account = accounts[account_id]
         if account:
             self.user = account[0]
-            self.password = account[1]
+            self._password_b64 = account[1]
+
+    @property
+    def password(self) -> str:
+        """
+        Decode the password on first use
+        :return: the decoded password of the user
+        """
+        if self._password is None and self._password_b64 is not None:
+            try:
+                self._password = base64.b64decode(self._password_b64, validate=True).decode('utf-8')
+            except (binascii.Error, UnicodeDecodeError) as ex:
+                raise IOError(f'Password of account {self.user} must be base64 encoded in the XML configuration, '
+                              'refer to the XML schema') from ex
+        return self._password
+
+    def forget_password(self) -> None:
+        """
+        Release the encoded and decoded passwords once they are not needed anymore
+        """
+        self._password_b64 = None
+        self._password = None
 
 
 class Settings:
     """
     Settings used by the IMAP deletion.
     """
-    source_server: ImapSettings = None  # settings of your source IMAP server
-    target_server: ImapSettings = None  # settings of your target IMAP server
-    path: str = None  # Path for the files used by the application
-    log_path: str  # Path to the logs file, not used in this version
-    log_level: str  # Level of logs, not used in this version
+    __slots__ = ('source_server', 'target_server', 'path', 'log_path', 'log_level')
+
+    def __init__(self):
+        """
+        Initialize
+        """
+        self.source_server: ImapSettings = None  # settings of your source IMAP server
+        self.target_server: ImapSettings = None  # settings of your target IMAP server
+        self.path: str = None  # Path for the files used by the application
+        self.log_path: str = None  # Path to the logs file, not used in this version
+        self.log_level: str = None  # Level of logs, not used in this version
 
     def parse(self, path: str) -> None:
         """
         Parse the XML configuration.
         """
-        with open(path, encoding='utf-8') as f:
-            tree = etree.parse(f)
-        root_node: etree.Element = tree.getroot()
-        log_node: etree.Element = root_node.find('log')
-        if log_node is not None:
-            v = log_node.get('path')
-            if v is not None:
-                self.log_path = str(v)
-            v = log_node.get('level')
-            if v is not None:
-                self.log_level = str(v)
         accounts = {}
-        for node in tree.findall('accounts/account'):
-            v1 = node.get('user')
-            v2 = node.get('password')
-            v3 = node.get('id')
-            if v1 is not None and v2 is not None and v3 is not None:
-                accounts[v3] = [v1, v2]
-        imap_node: etree.Element = root_node.find('source')
-        if imap_node is not None:
-            self.source_server = ImapSettings()
-            self.source_server.parse(imap_node, accounts)
-        else:
-            raise IOError('No source imap element specified in the XML configuration, refer to the XML schema')
-        imap_node = root_node.find('target')
-        if imap_node is not None:
-            self.target_server = ImapSettings()
-            self.target_server.parse(imap_node, accounts)
-        else:
-            raise IOError('No target imap element specified in the XML configuration, refer to the XML schema')
+        imap_nodes: dict = {}
+        root_node: etree.Element = None
+        for _, node in etree.iterparse(path, events=('end',)):
+            root_node = node
+            if node.tag == 'log':
+                v = node.get('path')
+                if v is not None:
+                    self.log_path = str(v)
+                v = node.get('level')
+                if v is not None:
+                    self.log_level = str(v)
+                node.clear()
+            elif node.tag == 'account':
+                v1 = node.get('user')
+                v2 = node.get('password')
+                v3 = node.get('id')
+                if v1 is not None and v2 is not None and v3 is not None:
+                    accounts[v3] = [v1, v2]
+                node.clear()
+            elif node.tag in {'source', 'target'}:
+                # Parsed once all the accounts are known
+                imap_nodes[node.tag] = node
+        self.source_server = self._parse_server(imap_nodes.get('source'), 'source', accounts)
+        self.target_server = self._parse_server(imap_nodes.get('target'), 'target', accounts)
+        if root_node is not None:
+            root_node.clear()
         self.path = os.path.dirname(path)
 
+    @staticmethod
+    def _parse_server(node: etree.Element, name: str, accounts: {}) -> ImapSettings:
+        """
+        Parse the IMAP server
+        :param node: the node or None if missing
+        :param name: the name of the node
+        :param accounts: the accounts
+        :return: the settings of the server
+        """
+        if node is None:
+            raise IOError(f'No {name} imap element specified in the XML configuration, refer to the XML schema')
+        result: ImapSettings = ImapSettings()
+        result.parse(node, accounts)
+        return result
+
 
 def create_rotating_log(path: str, level: str) -> logging.Logger:
     """
@@ -136,11 +180,9 @@ def create_rotating_log(path: str, level: str) -> logging.Logger:
     """
     result: logging.Logger = logging.getLogger("imap_move")
     path_obj: pathlib.Path = pathlib.Path(path)
-    if not os.path.exists(path_obj.parent.absolute()):
-        os.makedirs(path_obj.parent.absolute())
+    path_obj.parent.absolute().mkdir(parents=True, exist_ok=True)
     if os.path.exists(path):
-        with open(path, 'w', encoding='utf-8') as f:
-            f.close()
+        os.truncate(path, 0)
     else:
         path_obj.touch()
     # noinspection Spellchecker
@@ -153,33 +195,339 @@ def create_rotating_log(path: str, level: str) -> logging.Logger:
     # noinspection PyUnresolvedReferences
     file_handler.setLevel(level)
     file_handler.setFormatter(formatter)
-    result.addHandler(file_handler)
+    # Records are buffered and written to the file by batches, errors are written immediately
+    memory_handler: logging.Handler = MemoryHandler(capacity=1000, flushLevel=logging.ERROR, target=file_handler,
+                                                    flushOnClose=True)
+    memory_handler.setLevel(level)
+    result.addHandler(memory_handler)
+    atexit.register(memory_handler.flush)
     # noinspection PyUnresolvedReferences
     result.setLevel(level)
     return result
 
 
+def tune_socket(mailbox: imaplib.IMAP4) -> None:
+    """
+    Tune the socket of the IMAP session
+    :param mailbox: the IMAP session
+    """
+    mailbox.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    mailbox.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    mailbox.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+
+
+def get_capabilities(mailbox: imaplib.IMAP4) -> set:
+    """
+    Retrieve the capabilities advertised by the server
+    :param mailbox: the IMAP session
+    :return: the capabilities as upper case bytes
+    """
+    status, response = mailbox.capability()
+    if status != 'OK' or not response or not response[0]:
+        return set()
+    return set(response[0].upper().split())
+
+
+def build_uid_ranges(uids: list, max_len: int = MAX_UIDS_PER_COMMAND) -> list:
+    """
+    Build the IMAP sets of the UIDs (e.g. 1:50,52,60:100)
+    :param uids: the UIDs as bytes, strings or integers
+    :param max_len: the maximum number of UIDs covered by each set
+    :return: the list of sets
+    """
+    result: list = []
+    values: list = sorted(int(uid) for uid in uids)
+    for offset in range(0, len(values), max_len):
+        chunk = values[offset:offset + max_len]
+        ranges: list = []
+        start = end = chunk[0]
+        for value in chunk[1:]:
+            if value != end + 1:
+                ranges.append(str(start) if start == end else f'{start}:{end}')
+                start = value
+            end = value
+        ranges.append(str(start) if start == end else f'{start}:{end}')
+        result.append(','.join(ranges))
+    return result
+
+
+def move_messages(mailbox: imaplib.IMAP4, uids: list, folder: str, use_move: bool = True) -> int:
+    """
+    Move the messages on the server side
+    :param mailbox: the IMAP session with the source folder selected
+    :param uids: the UIDs of the messages to move
+    :param folder: the target folder on the same account
+    :param use_move: True if the server advertises the MOVE capability
+    :return: the number of moved messages
+    """
+    result: int = 0
+    command: str = 'MOVE' if use_move else 'COPY'
+    for offset in range(0, len(uids), MAX_UIDS_PER_COMMAND):
+        chunk: list = uids[offset:offset + MAX_UIDS_PER_COMMAND]
+        uid_set: str = build_uid_ranges(chunk)[0]
+        logger.debug('Moving messages: %s', uid_set)
+        status, response = mailbox.uid(command, uid_set, folder)
+        if status == 'OK':
+            if not use_move:
+                status, response = mailbox.uid('STORE', uid_set, '+FLAGS.SILENT', '(\\Deleted)')
+                if status != 'OK':
+                    # The copied messages would be copied again by the next run
+                    raise imaplib.IMAP4.error(f'STORE command error after COPY: {status} {response}')
+            result += len(chunk)
+            continue
+        text: bytes = b' '.join(v for v in response if isinstance(v, bytes)).upper()
+        if any(v in text for v in NON_FATAL_RESPONSES):
+            logger.warning('Messages not moved: %s (%s)', uid_set, text.decode(errors='replace'))
+        else:
+            raise imaplib.IMAP4.error(f'{command} command error: {status} {response}')
+    return result
+
+
+def _complete_fetches(mailbox: imaplib.IMAP4, pending: dict) -> set:
+    """
+    Read the responses of the pipelined UID FETCH commands
+    :param mailbox: the IMAP session
+    :param pending: the UIDs of the messages by tag
+    :return: the UIDs of the messages not fetched
+    """
+    result: set = set()
+    for tag, uid in pending.items():
+        try:
+            status, response = mailbox._command_complete('UID', tag)
+        except imaplib.IMAP4.abort:
+            raise
+        except imaplib.IMAP4.error as ex:
+            # BAD is handled as NO, the responses of the other commands are still read
+            status, response = 'BAD', ex
+        if status != 'OK':
+            logger.warning('Message %s not fetched: %s', uid, response)
+            result.add(uid)
+    return result
+
+
+def _pop_fetched(mailbox: imaplib.IMAP4) -> dict:
+    """
+    Pop the FETCH responses of the session
+    :param mailbox: the IMAP session
+    :return: the (response text, message) tuples by UID
+    """
+    result: dict = {}
+    items: list = mailbox.untagged_responses.pop('FETCH', [])
+    for index, item in enumerate(items):
+        # Literals are (header, data) tuples followed by the rest of the response
+        if isinstance(item, tuple):
+            trailer = items[index + 1] if index + 1 < len(items) and isinstance(items[index + 1], bytes) else b''
+            text: bytes = item[0] + b' ' + trailer
+            match = UID_PATTERN.search(text)
+            if match:
+                result[match.group(1)] = (text, item[1])
+    return result
+
+
+def fetch_messages(mailbox: imaplib.IMAP4, uids: list, parts: str, verbose: bool) -> Iterator:
+    """
+    Fetch the messages by pipelining the UID FETCH commands
+    :param mailbox: the IMAP session with the source folder selected
+    :param uids: the UIDs of the messages to fetch
+    :param parts: the data items to fetch, including UID
+    :param verbose: True to log each fetched message
+    :return: the (UID, response text, message) tuples, each message being released once consumed
+    """
+    pending: dict = {}
+    for uid in uids:
+        if verbose:
+            logger.info('Fetching message: %s', uid)
+        pending[mailbox._command('UID', 'FETCH', uid, parts)] = uid
+    failed: set = _complete_fetches(mailbox, pending)
+    # The list of the responses is released once popped, the messages are only referenced by fetched
+    fetched: dict = _pop_fetched(mailbox)
+    for uid in uids:
+        item = fetched.pop(uid, None)
+        if item:
+            yield uid, item[0], item[1]
+        elif uid not in failed:
+            logger.warning('Message %s not fetched: no response matching its UID', uid)
+
+
+def fetch_remaining(mailbox: imaplib.IMAP4, uid: bytes, response_text: bytes, first_part: bytes):
+    """
+    Fetch the rest of the message by slices until a short slice
+    :param mailbox: the IMAP session with the source folder selected
+    :param uid: the UID of the message
+    :param response_text: the text of the FETCH response of the first slice
+    :param first_part: the first slice of the message
+    :return: the first slice if the message is not larger, the whole message as a bytearray otherwise
+    """
+    if len(first_part) < FETCH_CHUNK_SIZE:
+        return first_part
+    match = SIZE_PATTERN.search(response_text)
+    size: int = int(match.group(1)) if match else 0
+    result: bytearray = bytearray(max(size, len(first_part)))
+    offset: int = len(first_part)
+    result[:offset] = first_part
+    part: bytes = first_part
+    while len(part) == FETCH_CHUNK_SIZE:
+        logger.debug('Fetching message: %s from offset: %s', uid, offset)
+        status, response = mailbox.uid('FETCH', uid, f'(BODY.PEEK[]<{offset}.{FETCH_CHUNK_SIZE}>)')
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f'Message {uid} not fetched from offset {offset}: {status} {response}')
+        part = next((item[1] for item in response if isinstance(item, tuple)), b'')
+        result[offset:offset + len(part)] = part
+        offset += len(part)
+    # RFC822.SIZE may overstate the size of the message
+    del result[offset:]
+    return result
+
+
+def send_append(mailbox: imaplib.IMAP4, folder: str, messages: list, literal_plus: bool) -> bytes:
+    """
+    Send the APPEND command of the messages without reading its response
+    :param mailbox: the IMAP session
+    :param folder: the folder where the messages are appended
+    :param messages: the list of (UID, flags, date, message) tuples, flags and quoted date being bytes
+    :param literal_plus: True if the server advertises the LITERAL+ capability
+    :return: the tag of the command
+    """
+    tag: bytes = mailbox._new_tag()
+    command: bytes = tag + b' APPEND ' + folder.encode(mailbox._encoding)
+    for _, flags, date, message in messages:
+        literal: bytes = imaplib.MapCRLF.sub(imaplib.CRLF, message)
+        command += b' (' + flags + b') ' + date + (b' {%d+}' if literal_plus else b' {%d}') % len(literal)
+        mailbox.send(command + imaplib.CRLF)
+        if not literal_plus:
+            while mailbox._get_response():
+                if mailbox.tagged_commands[tag]:  # BAD or NO instead of the continuation request
+                    return tag
+        # The literal is sent on its own to avoid copying it into the rest of the command
+        mailbox.send(literal)
+        command = b''
+    mailbox.send(command + imaplib.CRLF)
+    return tag
+
+
+def append_messages(mailbox: imaplib.IMAP4, folder: str, messages: list, capabilities: set) -> list:
+    """
+    Append the messages using MULTIAPPEND or LITERAL+ when supported
+    :param mailbox: the IMAP session
+    :param folder: the folder where the messages are appended
+    :param messages: the list of (UID, flags, date, message) tuples, flags and quoted date being bytes
+    :param capabilities: the capabilities of the server
+    :return: the list of (UID, (type, data)) tuples giving the result of the APPEND command of each message
+    """
+    literal_plus: bool = b'LITERAL+' in capabilities
+    if messages and b'MULTIAPPEND' in capabilities:
+        # MULTIAPPEND is atomic, all the messages are appended or none of them
+        result: tuple = mailbox._command_complete('APPEND', send_append(mailbox, folder, messages, literal_plus))
+        match = APPENDUID_PATTERN.search(result[1][0] or b'')
+        if match:
+            logger.debug('Messages appended with UIDs: %s', match.group(1).decode())
+        return [(message[0], result) for message in messages]
+    if not literal_plus:
+        return [(uid, mailbox.append(folder, flags.decode('ascii'), date.decode('ascii'), message))
+                for uid, flags, date, message in messages]
+    tags: list = [(message[0], send_append(mailbox, folder, [message], True)) for message in messages]
+    return [(uid, mailbox._command_complete('APPEND', tag)) for uid, tag in tags]
+
+
+def store_deleted(mailbox: imaplib.IMAP4, deletions: queue.Queue) -> None:
+    """
+    Flag as deleted the messages appended on the target
+    :param mailbox: the IMAP session with the source folder selected
+    :param deletions: the queue of the lists of UIDs to flag
+    """
+    uids: list = []
+    while not deletions.empty():
+        uids.extend(deletions.get_nowait())
+    for uid_set in build_uid_ranges(uids):
+        mailbox.uid('STORE', uid_set, '+FLAGS.SILENT', '(\\Deleted)')
+
+
+def fetch_worker(mailbox: imaplib.IMAP4, uids: list, messages: queue.Queue, deletions: queue.Queue, stop: threading.Event,
+                 *, verbose: bool) -> None:
+    """
+    Fetch the messages into the queue, ended by None or by the error
+    :param mailbox: the IMAP session with the source folder selected
+    :param uids: the UIDs of the messages to fetch
+    :param messages: the queue of the (UID, flags, date, message) tuples
+    :param deletions: the queue of the lists of UIDs appended on the target
+    :param stop: the event set to stop the fetching
+    :param verbose: True to log each fetched message
+    """
+    error: Exception = None
+    parts: str = f'(UID FLAGS INTERNALDATE RFC822.SIZE BODY.PEEK[]<0.{FETCH_CHUNK_SIZE}>)'
+    try:
+        for offset in range(0, len(uids), PIPELINE_DEPTH):
+            # The session is owned by the worker, the messages already appended are flagged between the batches
+            store_deleted(mailbox, deletions)
+            for uid, text, body in fetch_messages(mailbox, uids[offset:offset + PIPELINE_DEPTH], parts, verbose):
+                logger.debug('Retrieving flags and internal date')
+                envelope = ENVELOPE_PATTERN.search(text)
+                if not envelope:
+                    logger.warning('Message %s skipped, no flags or internal date in: %s', uid, text)
+                    continue
+                try:
+                    body = fetch_remaining(mailbox, uid, text, body)
+                except imaplib.IMAP4.abort:
+                    raise
+                except imaplib.IMAP4.error as ex:
+                    logger.warning('Message %s skipped: %s', uid, ex)
+                    continue
+                messages.put((uid, envelope.group('flags'), b'"' + envelope.group('date') + b'"', body))
+                body = None
+                if stop.is_set():
+                    return
+            # Drop the responses buffered by imaplib, no command is in flight at this point
+            mailbox.untagged_responses.clear()
+    except (imaplib.IMAP4.error, OSError) as ex:
+        logger.error('Messages not fetched: %s', ex)
+        error = ex
+    finally:
+        messages.put(error)
+
+
+def list_folders(mailbox: imaplib.IMAP4) -> str:
+    """
+    List the folders of the session
+    :param mailbox: the IMAP session
+    :return: the folders, one per line
+    """
+    return '\n'.join(' = '.join(v.decode('utf-8') for v in i.split(b' "/" ', 1)) for i in mailbox.list()[1])
+
+
 def cleanup() -> None:
     """
     Cleanup the instances and session
     """
-    logger.log(logging.INFO, "Cleaning...")
-    if 'source_mailbox' in globals():
-        if 'logger' in globals():
-            logger.info('Source IMAP session state: %s', source_mailbox.state)
-        if source_mailbox.state == 'SELECTED':
-            logger.log(logging.DEBUG, 'Closing...')
-            source_mailbox.expunge()
-            source_mailbox.close()
-            source_mailbox.logout()
-    if 'target_mailbox' in globals():
-        if 'logger' in globals():
-            logger.info('Target IMAP session state: %s', target_mailbox.state)
-        if target_mailbox.state == 'SELECTED':
-            logger.log(logging.DEBUG, 'Closing...')
-            target_mailbox.expunge()
-            target_mailbox.close()
-            target_mailbox.logout()
+    logger.info("Cleaning...")
+    if fetch_thread is not None and fetch_thread.is_alive():
+        logger.debug('Stopping fetch...')
+        fetch_stop.set()
+        # Unblock the worker waiting for free space in the queue
+        while not fetched_messages.empty():
+            fetched_messages.get_nowait()
+        fetch_thread.join()
+    if deleted_messages is not None and source_mailbox.state == 'SELECTED':
+        # Keep the progress when interrupted, the messages already appended are not moved again by the next run
+        try:
+            store_deleted(source_mailbox, deleted_messages)
+        except (imaplib.IMAP4.error, OSError) as ex:
+            logger.error('Appended messages not flagged as deleted: %s', ex)
+    for mailbox in _OPEN_MAILBOXES:
+        logger.info('IMAP session state on %s:%s: %s', mailbox.host, mailbox.port, mailbox.state)
+        if mailbox.state == 'SELECTED':
+            logger.debug('Closing...')
+            mailbox.expunge()
+            mailbox.close()
+            mailbox.logout()
+
+
+def _unquote(value: str) -> str:
+    """
+    Remove the single or double quotes surrounding the argument
+    :param value: the value of the argument
+    :return: the value without the surrounding quotes
+    """
+    return value[1:-1] if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'' else value
 
 
 # pylint: disable=missing-type-doc
@@ -194,20 +542,12 @@ def signal_handler(sig=None, frame=None) -> None:
 
 
 parser = argparse.ArgumentParser(prog='imap_move.py', description='Move messages from IMAP server to another one')
-parser.add_argument('-f', required=True, help='Configuration file')
-parser.add_argument('-l', help='Log level', default='INFO')
+parser.add_argument('-f', required=True, type=_unquote, help='Configuration file')
+parser.add_argument('-l', type=_unquote, help='Log level', default='INFO')
 parser.add_argument('-v', default=False, action='store_true', help='Verbose')
 args = parser.parse_args()
 LOG_LEVEL: str = args.l
-if LOG_LEVEL.startswith('"') and LOG_LEVEL.endswith('"'):
-    LOG_LEVEL = LOG_LEVEL[1:-1]
-if LOG_LEVEL.startswith("'") and LOG_LEVEL.endswith("'"):
-    LOG_LEVEL = LOG_LEVEL[1:-1]
 CONFIG_PATH: str = args.f
-if CONFIG_PATH.startswith('"') and CONFIG_PATH.endswith('"'):
-    CONFIG_PATH = CONFIG_PATH[1:-1]
-if CONFIG_PATH.startswith("'") and CONFIG_PATH.endswith("'"):
-    CONFIG_PATH = CONFIG_PATH[1:-1]
 if not os.path.exists(CONFIG_PATH):
     CONFIG_PATH = str(pathlib.Path(__file__).parent) + os.sep + CONFIG_PATH
 LOG_PATH: str = os.path.splitext(CONFIG_PATH)[0] + '.log'
@@ -216,7 +556,7 @@ settings.log_path = LOG_PATH
 settings.log_level = LOG_LEVEL
 settings.parse(os.path.abspath(CONFIG_PATH))
 logger = create_rotating_log(settings.log_path, settings.log_level)
-logger.info('Using arguments: %s', repr(args))
+logger.info('Using arguments: %r', args)
 
 if not args.f or not os.path.isfile(args.f):
     print('Input file is required and must be valid.')
@@ -226,63 +566,101 @@ LOCK_PATH: str = os.path.abspath(os.path.dirname(CONFIG_PATH)) + os.sep + '.imap
 logger.info('Log level set to: %s', logging.getLevelName(logger.level))
 atexit.register(signal_handler)
 signal.signal(signal.SIGINT, signal_handler)
-logger.info('Connecting to source server: %s:%s with user: %s', settings.source_server.server, str(settings.source_server.port), settings.source_server.user)
+logger.info('Connecting to source server: %s:%s with user: %s', settings.source_server.server, settings.source_server.port, settings.source_server.user)
 
 if settings.source_server.use_ssl:
     source_mailbox = imaplib.IMAP4_SSL(host=settings.source_server.server, port=settings.source_server.port)
 else:
     source_mailbox = imaplib.IMAP4(host=settings.source_server.server, port=settings.source_server.port)
 
+tune_socket(source_mailbox)
 source_mailbox.login(settings.source_server.user, settings.source_server.password)
+settings.source_server.forget_password()
+_OPEN_MAILBOXES.append(source_mailbox)
 
 if logger.isEnabledFor(logging.DEBUG):
-    buffer: str = 'Available folders on source:\n'
-    for i in source_mailbox.list()[1]:
-        p = i.decode().split(' "/" ')
-        buffer += (p[0] + " = " + p[1]) + '\n'
-    logger.log(logging.DEBUG, buffer)
+    logger.debug('Available folders on source:\n%s', list_folders(source_mailbox))
 
-logger.info('Connecting to target server: %s:%s with user: %s', settings.target_server.server, str(settings.target_server.port), settings.target_server.user)
+logger.info('Connecting to target server: %s:%s with user: %s', settings.target_server.server, settings.target_server.port, settings.target_server.user)
 
 if settings.target_server.use_ssl:
     target_mailbox = imaplib.IMAP4_SSL(host=settings.target_server.server, port=settings.target_server.port)
 else:
     target_mailbox = imaplib.IMAP4(host=settings.target_server.server, port=settings.target_server.port)
 
+tune_socket(target_mailbox)
 target_mailbox.login(settings.target_server.user, settings.target_server.password)
+settings.target_server.forget_password()
+_OPEN_MAILBOXES.append(target_mailbox)
 
 if logger.isEnabledFor(logging.DEBUG):
-    buffer: str = 'Available folders on target:\n'
-    for i in target_mailbox.list()[1]:
-        p = i.decode().split(' "/" ')
-        buffer += (p[0] + " = " + p[1]) + '\n'
-    logger.log(logging.DEBUG, buffer)
+    logger.debug('Available folders on target:\n%s', list_folders(target_mailbox))
 logger.info('Selecting folder on source: %s', settings.source_server.folder)
 source_mailbox.select(settings.source_server.folder)
 logger.info('Selecting folder on target: %s', settings.target_server.folder)
 target_mailbox.select(settings.target_server.folder)
-typ, data = source_mailbox.search(None, 'ALL')
+typ, data = source_mailbox.uid('SEARCH', None, 'ALL')
+message_uids: list = data[0].split() if data and data[0] else []
 count: int = 0
-
-for num in data[0].split():
-    logger.info('Fetching message: %s', str(num))
-    resp, data = source_mailbox.fetch(num, "(FLAGS INTERNALDATE BODY.PEEK[])")
-    message = data[0][1]
-    logger.log(logging.DEBUG, 'Retrieving flags')
-    flags = []
-    for flag in imaplib.ParseFlags(data[0][0]):
-        flags.append(flag.decode())
-    flag_str = ' '.join(flags)
-    logger.debug('Retrieving internal date')
-    date = imaplib.Time2Internaldate(imaplib.Internaldate2tuple(data[0][0]))
-    logger.debug('Moving message to folder: %s', settings.target_server.folder)
-    append_result = target_mailbox.append(settings.target_server.folder, flag_str, date, message)
-
-    if append_result and len(append_result) > 0 and str(append_result[0]).upper() == 'OK':
-        count = count + 1
-        source_mailbox.store(num, '+FLAGS', '\\Deleted')
-
-logger.info('%s messages moved', str(count))
+same_account: bool = ((settings.source_server.server, settings.source_server.port, settings.source_server.user)
+                      == (settings.target_server.server, settings.target_server.port, settings.target_server.user))
+
+if same_account and b'MOVE' in get_capabilities(source_mailbox):
+    logger.info('Moving %s messages using MOVE extension', len(message_uids))
+    count = move_messages(source_mailbox, message_uids, settings.target_server.folder)
+    message_uids = []
+elif same_account:
+    logger.info('Moving %s messages using COPY', len(message_uids))
+    count = move_messages(source_mailbox, message_uids, settings.target_server.folder, False)
+    message_uids = []
+
+target_capabilities: set = get_capabilities(target_mailbox)
+# Without MULTIAPPEND or LITERAL+, each message is appended as soon as it is fetched
+append_batch_size: int = APPEND_BATCH_SIZE if target_capabilities & {b'MULTIAPPEND', b'LITERAL+'} else 1
+appends: list = []
+appends_size: int = 0
+deleted_messages = queue.Queue()
+fetched_messages = queue.Queue(maxsize=FETCH_QUEUE_SIZE)
+fetch_stop = threading.Event()
+fetch_thread = threading.Thread(target=fetch_worker,
+                                args=(source_mailbox, message_uids, fetched_messages, deleted_messages, fetch_stop),
+                                kwargs={'verbose': args.v}, name='fetch', daemon=True)
+# Messages are appended on the target while the next ones are fetched from the source
+fetch_thread.start()
+
+while True:
+    fetched_message = fetched_messages.get()
+    fetch_ended: bool = fetched_message is None or isinstance(fetched_message, Exception)
+    if not fetch_ended:
+        appends.append(fetched_message)
+        appends_size += len(fetched_message[3])
+        if len(appends) < append_batch_size and appends_size < APPEND_BATCH_BYTES:
+            continue
+    logger.debug('Moving messages to folder: %s', settings.target_server.folder)
+    previous_count: int = count
+    appended_uids: list = []
+
+    for num, append_result in append_messages(target_mailbox, settings.target_server.folder, appends, target_capabilities):
+        if append_result and len(append_result) > 0 and str(append_result[0]).upper() == 'OK':
+            count = count + 1
+            appended_uids.append(num)
+    # Flagged by the fetch worker which owns the source session
+    deleted_messages.put(appended_uids)
+    if not args.v and count // PROGRESS_INTERVAL != previous_count // PROGRESS_INTERVAL:
+        logger.info('Moved %s/%s', count, len(message_uids))
+    appends = []
+    appends_size = 0
+    if fetch_ended:
+        break
+    fetched_message = None  # Released before waiting for the next message
+
+fetch_thread.join()
+store_deleted(source_mailbox, deleted_messages)
+if fetched_message is not None:
+    # The messages not fetched stay in the source folder and the trash is kept
+    raise fetched_message
+
+logger.info('%s messages moved', count)
 source_mailbox.select(settings.source_server.trash)  # select trash
-source_mailbox.store("1:*", '+FLAGS', '\\Deleted')  # flag all trash as Deleted
+source_mailbox.store("1:*", '+FLAGS.SILENT', '(\\Deleted)')  # flag all trash as Deleted
 sys.exit(0)